@@ -42,10 +42,10 @@ class lmnn(object):
         self.extractor.add(layer)
     
     #%%    
-    def compile(self, k=1, optimizer='adam', learning_rate = 1e-4, 
-              mu=0.5, margin=1):
-        """ Builds the tensorflow graph that is evaluated in the fit method 
-        
+    def compile(self, k=1, optimizer='adam', learning_rate = 1e-4,
+              mu=0.5, margin=1, mixed_precision=False):
+        """ Builds the tensorflow graph that is evaluated in the fit method
+
         Arguments:
             k: integer, number of target neighbours
             optimizer: string, name of optimizer to use. See dlmnn.helper.utility
@@ -56,6 +56,10 @@ class lmnn(object):
                 the pull term
             margin: scalar, size of margin inforcing between similar pairs and
                 imposters. Should be higher than 0.
+            mixed_precision: bool, if true the pairwise distance computations
+                run their inner products in float16 (fast and half the memory
+                traffic on modern GPUs). Margin comparisons and the loss stay
+                in float32
         """
         assert k > 0 and isinstance(k, int), ''' k need to be a positive integer '''   
         assert learning_rate > 0, ''' learning rate needs to be a positive number '''
@@ -65,45 +69,110 @@ class lmnn(object):
                 lmnn.add() method before this function is called '''
         
         self.built = True
-        
-        # Set number of neighbours
-        self.k = k        
+
+        # Set number of neighbours and loss parameters
+        self.k = k
+        self.mu = mu
+        self.margin = margin
+        self._metric_dtype = tf.float16 if mixed_precision else None
 
         # Shapes
         self.input_shape = self.extractor.input_shape
         self.output_shape = self.extractor.output_shape
-        
+
         # Placeholders for data
         self.global_step = tf.Variable(0, trainable=False)
         self.Xp = tf.placeholder(tf.float32, shape=self.input_shape, name='In_features')
         self.yp = tf.placeholder(tf.int32, shape=(None,), name='In_targets')
         self.tNp = tf.placeholder(tf.int32, shape=(None, 2), name='In_targetNeighbours')
-        
+
         # Feature extraction function and pairwise distance function
         self.extractor_func = tf_featureExtractor(self.extractor)
         self.dist_func = tf_makePairwiseFunc(self.extractor_func)
-        
-        # Build graph
-        #D = self.dist_func(self.Xp, self.Xp)
-        D = self.dist_func(self.Xp)
-        tup = tf_findImposters(D, self.yp, self.tNp, margin=margin)
-        self._LMNN_loss, D_1, D_2, D_3 = tf_LMNN_loss(D, self.tNp, tup, mu, margin=margin)
-        
+
+        # Evaluation graph on the placeholders; this also builds the layers
+        self._pull_kernel = None
+        self._LMNN_loss, self._n_tup, self._true_imp = \
+                self._build_graph(self.Xp, self.yp, self.tNp)[:3]
+
+        # For a purely linear transformer the pull distances can be computed
+        # from cached input differences of the fixed target neighbour pairs
+        self._pull_kernel = self._linear_kernel()
+
+        # Input pipeline for training. The batch builder feeds a tf.data
+        # iterator, so host side batch construction and host->device transfer
+        # overlap with the training step through the prefetch
+        self._train_batches = None
+        output_types = (tf.float32, tf.int32, tf.int32)
+        output_shapes = (tf.TensorShape(self.input_shape),
+                         tf.TensorShape([None]),
+                         tf.TensorShape([None, 2]))
+        if self._pull_kernel is not None:
+            # Device resident cache of the pull-pair differences, uploaded
+            # once per fit; batches only carry int32 row ids into it
+            d_in = int(np.prod(self.input_shape[1:]))
+            self._pair_diff_p = tf.placeholder(tf.float32, shape=(None, d_in))
+            self._pair_diff = tf.Variable(self._pair_diff_p, trainable=False,
+                                          collections=[], validate_shape=False)
+            output_types += (tf.int32,)
+            output_shapes += (tf.TensorShape([None]),)
+        dataset = tf.data.Dataset.from_generator(
+                lambda: self._train_batches,
+                output_types=output_types, output_shapes=output_shapes)
+        dataset = dataset.prefetch(2)
+        self._iterator = dataset.make_initializable_iterator()
+        if self._pull_kernel is not None:
+            Xd, yd, tNd, rowsd = self._iterator.get_next()
+        else:
+            Xd, yd, tNd = self._iterator.get_next()
+            rowsd = None
+
+        # Training graph on the dataset tensors, sharing weights with the
+        # evaluation graph
+        loss, n_tup, true_imp, D_1, D_2, D_3, features = \
+                self._build_graph(Xd, yd, tNd, pull_rows=rowsd)
+        self._train_loss = loss
+        self._train_n_tup = n_tup
+        self._train_true_imp = true_imp
+
         # Construct training operation
         self._optimizer = get_optimizer(optimizer)(learning_rate=learning_rate)
-        self._trainer = self._optimizer.minimize(self._LMNN_loss, 
+        self._trainer = self._optimizer.minimize(self._train_loss,
                                                  global_step=self.global_step)
-        
-        # Summaries
-        self._n_tup = tf.shape(tup)[0]
-        self._true_imp = tf.cast(tf.less(D_3, D_2), tf.float32)
-        features = self.extractor_func(self.Xp)
-        tf.summary.scalar('Loss', self._LMNN_loss) 
-        tf.summary.scalar('Num_imp', self._n_tup)
+
+        # Fused multi-step training op: runs a whole span of iterator-driven
+        # steps inside a single session.run through a while_loop, so the
+        # Python/session dispatch overhead is paid once per span instead of
+        # once per batch. fit() uses it when no per-batch output is wanted.
+        # The optimizer slots are shared with the per-batch trainer above
+        self._steps_p = tf.placeholder(tf.int32, shape=(), name='In_steps')
+        def _multi_cond(i, loss_sum, ntup_sum):
+            return tf.less(i, self._steps_p)
+        def _multi_body(i, loss_sum, ntup_sum):
+            batch = self._iterator.get_next()
+            if self._pull_kernel is not None:
+                X_s, y_s, tN_s, rows_s = batch
+            else:
+                X_s, y_s, tN_s = batch
+                rows_s = None
+            loss_s, n_tup_s = self._build_graph(X_s, y_s, tN_s,
+                                                pull_rows=rows_s)[:2]
+            train_op = self._optimizer.minimize(loss_s,
+                                                global_step=self.global_step)
+            with tf.control_dependencies([train_op]):
+                return i + 1, loss_sum + tf.identity(loss_s), ntup_sum + n_tup_s
+        self._multi_step = tf.while_loop(
+                _multi_cond, _multi_body,
+                [tf.constant(0), tf.constant(0.0), tf.constant(0)],
+                parallel_iterations=1, back_prop=False)
+
+        # Summaries (on the training path)
+        tf.summary.scalar('Loss', self._train_loss)
+        tf.summary.scalar('Num_imp', self._train_n_tup)
         tf.summary.scalar('Loss_pull', tf.reduce_sum(D_1))
         tf.summary.scalar('Loss_push', tf.reduce_sum(margin + D_2 - D_3))
-        tf.summary.scalar('True_imp', tf.reduce_sum(self._true_imp))
-        tf.summary.scalar('Frac_true_imp', tf.reduce_mean(self._true_imp))
+        tf.summary.scalar('True_imp', tf.reduce_sum(self._train_true_imp))
+        tf.summary.scalar('Frac_true_imp', tf.reduce_mean(self._train_true_imp))
         tf.summary.scalar('Sparsity_tanh', tf.reduce_mean(tf.reduce_sum(
                 tf.tanh(tf.pow(features, 2.0)), axis=1)))
         tf.summary.scalar('Sparsity_l0', tf.reduce_mean(tf.reduce_sum(
@@ -198,47 +267,84 @@ class lmnn(object):
         
         # Target neighbours and imposters
         if tN is None:
-            tN = findTargetNeighbours(Xtrain, ytrain, self.k, name='training')
+            tN = findTargetNeighbours(Xtrain, ytrain, self.k, name='training',
+                                      cache_dir=self.dir_loc)
         if imp is None:
             imp = findImposterNeighbours(Xtrain, ytrain, self.k, name='training')
         if validation and tN_val is None:
-            tN_val = findTargetNeighbours(Xval, yval, self.k, name='validation')
+            tN_val = findTargetNeighbours(Xval, yval, self.k, name='validation',
+                                          cache_dir=self.dir_loc)
         if validation and imp_val is None:
             imp_val = findImposterNeighbours(Xval, yval, self.k, name='validation')
             
+        # The target neighbour pairs are fixed for the whole fit, so for a
+        # linear transformer the input differences entering the pull term are
+        # computed and uploaded to the device once; the batches only carry
+        # row ids into the cached matrix
+        if self._pull_kernel is not None:
+            Xflat = np.reshape(Xtrain, (N_train, -1))
+            self.session.run(self._pair_diff.initializer, feed_dict={
+                    self._pair_diff_p: Xflat[tN[:,0]] - Xflat[tN[:,1]]})
+
         # Training loop
         stats = stat_logger(maxEpoch, self.k*n_batch_train, verbose=verbose)
         stats.on_train_begin() # Start training
         for e in range(maxEpoch):
             stats.on_epoch_begin() # Start epoch
             
-            # Do backpropagation
-            for b, (X_batch, y_batch, tN_batch) in enumerate(
-                    lmnn_batch_builder(Xtrain, ytrain, tN, imp, self.k, batch_size)):
+            # Hook a fresh (reshuffled) batch builder into the input pipeline
+            self._train_batches = lmnn_batch_builder(
+                    Xtrain, ytrain, tN, imp, self.k, batch_size,
+                    yield_rows=self._pull_kernel is not None)
+            self.session.run(self._iterator.initializer)
+
+            # Do backpropagation. With no per-batch output requested, the
+            # whole epoch runs as one fused multi-step call
+            if verbose == 0:
                 stats.on_batch_begin() # Start batch
-                
-                # Construct feed dict
-                feed_dict = {self.Xp: X_batch, self.yp: y_batch, self.tNp: tN_batch}
-                
-                # Evaluate graph
-                _, loss_out, ntup_out, ntup_true_out, summ = self.session.run(
-                        [self._trainer, self._LMNN_loss, self._n_tup,
-                         self._true_imp, self._summary], 
-                         feed_dict=feed_dict)
-                
-                # Save stats
-                stats.add_stat('loss', loss_out)
-                stats.add_stat('#imp', ntup_out)
-                if ntup_true_out.size: # find frac of true imposters
-                    stats.add_stat('Frac_true_imp', np.mean(ntup_true_out))
-                
-                # Save to tensorboard
-                if verbose==2: 
-                    self._writer.add_summary(summ, global_step=b+n_batch_train*e)
+                n_steps = len(self._train_batches)
+                _, loss_sum, ntup_sum = self.session.run(self._multi_step,
+                        feed_dict={self._steps_p: n_steps})
+                # Record the epoch mean, so the early-stopping signal sees
+                # the same quantity as the per-batch loop
+                stats.add_stat('loss', loss_sum / n_steps)
+                stats.add_stat('#imp', ntup_sum)
                 stats.on_batch_end() # End batch
+            else:
+                for b in range(len(self._train_batches)):
+                    stats.on_batch_begin() # Start batch
+
+                    # Evaluate graph, input comes from the dataset iterator
+                    try:
+                        _, loss_out, ntup_out, ntup_true_out, summ = self.session.run(
+                                [self._trainer, self._train_loss, self._train_n_tup,
+                                 self._train_true_imp, self._summary])
+                    except tf.errors.OutOfRangeError:
+                        break
+
+                    # Save stats
+                    stats.add_stat('loss', loss_out)
+                    stats.add_stat('#imp', ntup_out)
+                    if ntup_true_out.size: # find frac of true imposters
+                        stats.add_stat('Frac_true_imp', np.mean(ntup_true_out))
+
+                    # Save to tensorboard
+                    if verbose==2:
+                        self._writer.add_summary(summ, global_step=b+n_batch_train*e)
+                    stats.on_batch_end() # End batch
                        
             # If we are at an snapshot epoch and are doing validation
-            if validation and ((e+1) % snapshot == 0 or (e+1) == maxEpoch or e==0):
+            snapshot_epoch = (e+1) % snapshot == 0
+            val_epoch = validation and (snapshot_epoch or (e+1) == maxEpoch or e==0)
+
+            # Transform the data once and share it between the validation
+            # accuracy and the imposter recomputation
+            if snapshot_epoch or val_epoch:
+                Xtrain_trans = self.transform(Xtrain)
+                if validation:
+                    Xval_trans = self.transform(Xval)
+
+            if val_epoch:
                 # Evaluate loss and tuples on val data
                 for X_batch, y_batch, tN_batch in lmnn_batch_builder(
                         Xval, yval, tN_val, imp_val, self.k, batch_size):
@@ -249,8 +355,9 @@ class lmnn(object):
                     loss_out= self.session.run(self._LMNN_loss, feed_dict=feed_dict)
                     stats.add_stat('loss_val', loss_out)
                 
-                # Compute accuracy
-                acc = self.evaluate(Xval, yval, Xtrain, ytrain, batch_size=batch_size)
+                # Compute accuracy on the already transformed data
+                pred = knnClassifier(Xval_trans, Xtrain_trans, ytrain, self.k)
+                acc = np.mean(pred == yval)
                 stats.add_stat('acc_val', acc)
                 
                 if verbose==2:
@@ -265,12 +372,11 @@ class lmnn(object):
                     self._writer.add_summary(summ, global_step=n_batch_train*e)
             
             # If we are at an snapshot epoch, then recompute the imposters
-            if (e+1) % snapshot == 0:
-                Xtrain_trans = self.transform(Xtrain)
-                Xval_trans = self.transform(Xval)
+            if snapshot_epoch:
                 imp = findImposterNeighbours(Xtrain_trans, ytrain, self.k, name='training')
-                imp_val = findImposterNeighbours(Xval_trans, yval, self.k, name='validation')
-                
+                if validation:
+                    imp_val = findImposterNeighbours(Xval_trans, yval, self.k, name='validation')
+
             stats.on_epoch_end() # End epoch
             
             # Check if we should terminate
@@ -319,8 +425,15 @@ class lmnn(object):
             pred: N x 1, vector with predicted labels
         '''
         self._assert_if_build()
-        Xtest = self.transform(Xtest, batch_size=batch_size)
-        Xtrain = self.transform(Xtrain, batch_size=batch_size)
+        # Transform both sets in one batched call, so the device only spins
+        # up once; when test and train are the same array, transform it once
+        if Xtest is Xtrain:
+            Xtest = Xtrain = self.transform(Xtest, batch_size=batch_size)
+        else:
+            N_test = Xtest.shape[0]
+            X_trans = self.transform(np.concatenate([Xtest, Xtrain]),
+                                     batch_size=batch_size)
+            Xtest, Xtrain = X_trans[:N_test], X_trans[N_test:]
         pred = knnClassifier(Xtest, Xtrain, ytrain, self.k)
         return pred
     
@@ -390,6 +503,63 @@ class lmnn(object):
         print('Input shape:               ', self.extractor.input_shape)
         self.extractor.summary()
     
+    #%%
+    def _linear_kernel(self):
+        """ If the extractor is a purely linear transformer (a single Dense
+            layer without activation, optionally surrounded by shape-only
+            layers), return its kernel variable, else None """
+        from tensorflow.python.keras.layers import Dense, Flatten, InputLayer
+        from tensorflow.python.keras import activations
+        kernel = None
+        for layer in self.extractor.layers:
+            if isinstance(layer, Dense):
+                if kernel is not None or layer.activation is not activations.linear:
+                    return None
+                kernel = layer.kernel
+            elif not isinstance(layer, (Flatten, InputLayer)):
+                return None
+        return kernel
+
+    #%%
+    def _build_graph(self, X, y, tN, pull_rows=None):
+        """ Builds the imposter search and loss on the given input tensors.
+            Called once for the dataset input pipeline and once for the
+            placeholder based evaluation path; the extractor weights are
+            shared between the two.
+
+        The loss only consumes distances at index pairs, so it works on the
+        flatten features instead of a dense distance matrix. Features and
+        squared norms are computed once and shared between the imposter
+        search, the loss and the summaries, and the index matrix is unpacked
+        into contiguous vectors once.
+
+        When pull_rows is given (linear transformer only), the pull
+        distances are computed as |diff * W|^2 from the matching rows of the
+        device resident difference cache instead of from the transformed
+        batch.
+        """
+        features = self.extractor_func(X)
+        Z = tf.reshape(features, (tf.shape(X)[0], -1))
+        sq = tf.reduce_sum(tf.square(Z), axis=1)
+        tN_i, tN_j = tf.unstack(tN, num=2, axis=1)
+        tup_i, tup_j, tup_l = tf_findImposters(Z, y, tN_i, tN_j,
+                                               margin=self.margin, sq=sq,
+                                               dtype=self._metric_dtype)
+        D_pull = None
+        if pull_rows is not None and self._pull_kernel is not None:
+            # The bias cancels in the difference, so |z_i - z_j|^2 = |d*W|^2
+            diff = tf.gather(self._pair_diff, pull_rows)
+            diff.set_shape([None, int(np.prod(self.input_shape[1:]))])
+            D_pull = tf.reduce_sum(tf.square(
+                    tf.matmul(diff, self._pull_kernel)), axis=1)
+        loss, D_1, D_2, D_3 = tf_LMNN_loss(Z, tN_i, tN_j, tup_i, tup_j, tup_l,
+                                           self.mu, margin=self.margin, sq=sq,
+                                           dtype=self._metric_dtype,
+                                           D_pull=D_pull)
+        n_tup = tf.shape(tup_i)[0]
+        true_imp = tf.cast(tf.less(D_3, D_2), tf.float32)
+        return loss, n_tup, true_imp, D_1, D_2, D_3, features
+
     #%%
     def _get_feed_dict(self, idx_start, idx_end, X, y, tN):
         """ Utility function for getting a batch of data """
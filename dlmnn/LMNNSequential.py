@@ -136,9 +136,9 @@ class sequental_lmnn(lmnn):
         n_models = len(self.model_list)
         
         # Find initial tNs
-        tN = [findTargetNeighbours(Xtrain, ytrain, k)]
+        tN = [findTargetNeighbours(Xtrain, ytrain, k, cache_dir=self.dir_loc)]
         if validation:
-            tN_val = [findTargetNeighbours(Xval, yval, k)]
+            tN_val = [findTargetNeighbours(Xval, yval, k, cache_dir=self.dir_loc)]
         
         # Loop through models
         all_stats = [ ]
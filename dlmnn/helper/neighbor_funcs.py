@@ -11,8 +11,47 @@ from sklearn.neighbors import NearestNeighbors, KNeighborsClassifier
 from sklearn.decomposition import PCA
 from sklearn.metrics import pairwise_distances
 from tqdm import tqdm
+import hashlib, os
 from .utility import batchifier
 
+# Numba is optional; when installed the inner neighbour search loop is
+# jit-compiled and parallelized over all cores
+try:
+    from numba import njit, prange
+    _has_numba = True
+except ImportError:
+    _has_numba = False
+
+#%%
+if _has_numba:
+    @njit(parallel=True, fastmath=True)
+    def _knn_search_numba(x, k):
+        ''' Exact k nearest neighbour search, one insertion-sorted candidate
+            list per row, parallelized over rows. Uses O(n*k) memory instead
+            of the O(n^2) distance matrix of the numpy path '''
+        n, d = x.shape
+        nn = np.empty((n, k), np.int64)
+        for i in prange(n):
+            best_d = np.full(k, np.inf)
+            best_i = np.zeros(k, np.int64)
+            for j in range(n):
+                if j == i:
+                    continue
+                dist = 0.0
+                for l in range(d):
+                    diff = x[i,l] - x[j,l]
+                    dist += diff*diff
+                if dist < best_d[k-1]:
+                    pos = k-1
+                    while pos > 0 and best_d[pos-1] > dist:
+                        best_d[pos] = best_d[pos-1]
+                        best_i[pos] = best_i[pos-1]
+                        pos -= 1
+                    best_d[pos] = dist
+                    best_i[pos] = j
+            nn[i] = best_i
+        return nn
+
 #%%
 def compare_tN(A, B, k):
     ''' Compares a list of target neighbours in A to a list of target neighbours
@@ -44,8 +83,109 @@ def similarity_tN(list_tN, k):
     return sim_mat.round(3)
 
 #%%
-def findTargetNeighbours(X, y, k, do_pca=True, name=None):
-    ''' Numpy/sklearn implementation to find target neighbours for large 
+_gpu_available = None
+def _has_gpu():
+    ''' Check once whether tensorflow can see a GPU '''
+    global _gpu_available
+    if _gpu_available is None:
+        import tensorflow as tf
+        _gpu_available = tf.test.is_gpu_available()
+    return _gpu_available
+
+#%%
+def _knn_search_gpu(x, k, batch_size=1024):
+    ''' Exact k nearest neighbour search on the GPU. The pairwise distances
+        are computed in row blocks as |x|^2 + |y|^2 - 2*x^T*y, with the inner
+        product done as a single matmul per block, and the k+1 smallest
+        entries selected with top_k on device so only the indices are
+        transferred back to the host
+    Arguments:
+        x: N x d matrix with data
+        k: scalar, number of neighbours to find
+        batch_size: scalar, number of rows to process per block
+    Output:
+        indices: N x (k+1) matrix, row i holds i itself followed by the
+            indices of the k nearest neighbours of point i
+    '''
+    import tensorflow as tf
+    n, d = x.shape
+    graph = tf.Graph()
+    with graph.as_default():
+        X_full = tf.constant(x, tf.float32)
+        sq = tf.reduce_sum(tf.square(X_full), axis=1)
+        X_block = tf.placeholder(tf.float32, shape=(None, d))
+        sq_block = tf.reduce_sum(tf.square(X_block), axis=1)
+        dist = tf.expand_dims(sq_block, 1) + tf.expand_dims(sq, 0) \
+               - 2.0*tf.matmul(X_block, X_full, transpose_b=True)
+        _, nn_op = tf.nn.top_k(-dist, k=k+1)
+    indices = np.zeros((n, k+1), np.int64)
+    with tf.Session(graph=graph) as sess:
+        for b in range(int(np.ceil(n / batch_size))):
+            x_batch = x[batch_size*b:batch_size*(b+1)]
+            indices[batch_size*b:batch_size*(b+1)] = sess.run(
+                    nn_op, feed_dict={X_block: x_batch})
+    return indices
+
+#%%
+def _knn_search(x, k):
+    ''' Find the k+1 nearest neighbours (including the point itself) of every
+        row in x. Uses a tree based sklearn index by default; for very large
+        inputs an approximate hnsw index is used instead when hnswlib is
+        installed, since an exact search does not scale to that regime
+    Arguments:
+        x: N x d matrix with data
+        k: scalar, number of neighbours to find
+    Output:
+        indices: N x (k+1) matrix, row i holds i itself followed by the
+            indices of the k nearest neighbours of point i
+    '''
+    n, d = x.shape
+    if n > 50000:
+        if _has_gpu():
+            return _knn_search_gpu(x, k)
+        try:
+            import hnswlib
+            index = hnswlib.Index(space='l2', dim=d)
+            index.init_index(max_elements=n, ef_construction=200, M=16)
+            index.add_items(x)
+            index.set_ef(max(50, 2*(k+1)))
+            indices, _ = index.knn_query(x, k=k+1)
+            return indices.astype(np.int64)
+        except ImportError:
+            pass # fall back to the exact search
+    if n <= 5000:
+        # The numba kernel cannot fill its candidate list for n <= k and
+        # would silently return index 0 padding; fall through to the exact
+        # path, which raises loudly like the other backends
+        if _has_numba and n > k:
+            nn = _knn_search_numba(np.ascontiguousarray(x), k)
+            return np.concatenate((np.arange(n)[:,None], nn), axis=1)
+        # Small enough to do a dense distance matrix in one shot, with
+        # argpartition selecting the k nearest in O(n*k) instead of a sort
+        sqnorm = np.sum(x*x, axis=1)
+        dist = sqnorm[:,None] + sqnorm[None,:] - 2.0*(x @ x.T)
+        np.fill_diagonal(dist, np.inf)
+        nn = np.argpartition(dist, k, axis=1)[:,:k]
+        return np.concatenate((np.arange(n)[:,None], nn), axis=1)
+    nbrs = NearestNeighbors(n_neighbors=k+1, algorithm='auto', n_jobs=-1)
+    nbrs.fit(x)
+    _, indices = nbrs.kneighbors(x)
+    return indices
+
+#%%
+def _tN_cache_file(X, y, k, do_pca, cache_dir):
+    ''' Filename for a cached target neighbour matrix, keyed by a hash of the
+        data, the labels, the number of neighbours and the pca setting '''
+    hasher = hashlib.blake2b()
+    hasher.update(np.ascontiguousarray(X).tobytes())
+    hasher.update(np.ascontiguousarray(y).tobytes())
+    hasher.update(str(k).encode())
+    hasher.update(str(do_pca).encode())
+    return cache_dir + '/tN_cache/' + hasher.hexdigest() + '.npy'
+
+#%%
+def findTargetNeighbours(X, y, k, do_pca=True, name=None, cache_dir=None):
+    ''' Numpy/sklearn implementation to find target neighbours for large
         datasets. This function cannot use the GPU and thus runs on the CPU,
         but instead uses an advance ball-tree method.
     Arguments:
@@ -55,10 +195,19 @@ def findTargetNeighbours(X, y, k, do_pca=True, name=None):
         do_pca: bool, if true then the data will first be projected onto
             a pca-space which captures 95% of the variation in data
         name: str, name of the dataset
+        cache_dir: str, if given the resulting tN matrix is cached on disk in
+            this directory, and repeated calls with the same (X, y, k) skip
+            the neighbour search entirely
     Output:
-        tN: (N*k) x 2 matrix, with target neighbour index. 
+        tN: (N*k) x 2 matrix, with target neighbour index.
     '''
     name = ' for ' + name if name is not None else ''
+    # Since the target neighbours are computed on the raw data, they never
+    # change between runs on the same dataset, so check the disk cache first
+    if cache_dir is not None:
+        cache_file = _tN_cache_file(X, y, k, do_pca, cache_dir)
+        if os.path.isfile(cache_file):
+            return np.load(cache_file)
     # Reshape data into 2D
     N = X.shape[0]
     X = np.reshape(X, (N, -1))
@@ -70,23 +219,25 @@ def findTargetNeighbours(X, y, k, do_pca=True, name=None):
     tN_count = 0
     tN = np.zeros((N*k, 2), np.int32)
     # Iterate over each class
-    with tqdm(total=N, desc='Finding target neighbours' + name) as progress_bar:
+    with tqdm(total=N, desc='Finding target neighbours' + name,
+              mininterval=0.5) as progress_bar:
         for c in val:
             # Extract class c
             idx = np.where(y==c)[0]
             n_c = len(idx)
             x = X[idx]
-            # Find the nearest neighbours
-            nbrs = NearestNeighbors(n_neighbors=k+1, algorithm='brute')
-            nbrs.fit(x)
-            _, indices = nbrs.kneighbors(x)
-            for kk in range(1,k+1):
-                tN[tN_count:tN_count+n_c,0] = idx[indices[:,0]]
-                tN[tN_count:tN_count+n_c,1] = idx[indices[:,kk]]
-                tN_count += n_c
+            # Find the nearest neighbours and write all k columns in one go
+            indices = _knn_search(x, k)
+            tN[tN_count:tN_count+n_c*k,0] = idx[indices[:,0]].repeat(k)
+            tN[tN_count:tN_count+n_c*k,1] = idx[indices[:,1:k+1]].ravel()
+            tN_count += n_c*k
             counter += 1
             progress_bar.update(n_c)
     tN = tN[np.argsort(tN[:,0])] # sort by first observation
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir + '/tN_cache'):
+            os.makedirs(cache_dir + '/tN_cache')
+        np.save(cache_file, tN)
     return tN
 
 #%%
@@ -101,20 +252,48 @@ def findImposterNeighbours(X, y, k, do_pca=True, name=None, batch_size=256):
         pca = PCA(n_components = 0.95)
         X = pca.fit_transform(X)
         
-    # Loop over all points (in batches), and find closest neighbours with different labels
+    # Find the k closest neighbours with a different label for every point
     imp = np.zeros((N*k, 2), np.int32)
+    imp[:,0] = np.repeat(np.arange(N, dtype=np.int32), k)
+
+    # For large N an approximate hnsw index is queried with an expanding
+    # candidate count until every point has k cross-class neighbours, which
+    # avoids the O(N^2) distance computation entirely
+    if N > 20000:
+        try:
+            import hnswlib
+            index = hnswlib.Index(space='l2', dim=X.shape[1])
+            index.init_index(max_elements=N, ef_construction=200, M=16)
+            index.add_items(X)
+            m = min(N, max(50, 10*k))
+            while True:
+                index.set_ef(m + 10)
+                labels, _ = index.knn_query(X, k=m)
+                mask = y[labels] != y[:,None]
+                if m >= N or np.all(np.sum(mask, axis=1) >= k):
+                    break
+                m = min(N, 2*m) # too few cross-class candidates, widen search
+            pick = np.logical_and(mask, np.cumsum(mask, axis=1) <= k)
+            rows, cols = np.nonzero(pick)
+            imp[:,1] = labels[rows, cols]
+            return imp
+        except ImportError:
+            pass # fall back to the exact search
+
+    # Exact search: batched distances, candidates in increasing distance and
+    # the first k differently labelled ones selected with a vectorized mask
     counter = 0
-    with tqdm(total=N, desc='Finding imposters' + name) as progress_bar:
+    with tqdm(total=N, desc='Finding imposters' + name,
+              mininterval=0.5) as progress_bar:
         for X_batch in batchifier(X, batch_size):
             dist = pairwise_distances(X_batch, X)
             n = dist.shape[0]
-            idx = np.argsort(dist, axis=1)
-            y_idx = y[idx]
-            for i in range(n):
-                imp_idx = np.where(y_idx[i,0] != y_idx[i])[0]
-                imp[(counter+i)*k:(counter+i+1)*k] = np.vstack((k*[counter+i], 
-                                                              idx[i,imp_idx[:k]])).T
-            counter += batch_size
+            order = np.argsort(dist, axis=1)
+            mask = y[order] != y[counter:counter+n, None]
+            pick = np.logical_and(mask, np.cumsum(mask, axis=1) <= k)
+            rows, cols = np.nonzero(pick)
+            imp[counter*k:(counter+n)*k, 1] = order[rows, cols]
+            counter += n
             progress_bar.update(n)
     return imp
 
@@ -141,17 +320,23 @@ def knnClassifier(Xtest, Xtrain, ytrain, k):
     """
     Ntest = Xtest.shape[0]
     Ntrain = Xtrain.shape[0]
+    # Cheap checks first: identical objects are trivially the same set, and
+    # differing shapes trivially are not; only for equally shaped distinct
+    # arrays is the full element comparison needed
+    same = Xtest is Xtrain
     Xtest = np.reshape(Xtest, (Ntest, -1))
     Xtrain = np.reshape(Xtrain, (Ntrain, -1))
-    same = np.array_equal(Xtest, Xtrain)
+    if not same and Xtest.shape == Xtrain.shape:
+        same = np.array_equal(Xtest, Xtrain)
     if same: # if train and test is same, account for over estimation of
              # performance by one more neighbour and zero weight to the first
-        classifier = KNeighborsClassifier(n_neighbors = k+1, weights=_weight_func, 
-                                          algorithm='brute')
-        classifier.fit(Xtrain, ytrain)
-        pred = classifier.predict(Xtest)
+        classifier = KNeighborsClassifier(n_neighbors = k+1, weights=_weight_func,
+                                          algorithm='brute', n_jobs=-1)
     else:
-        classifier = KNeighborsClassifier(n_neighbors = k, algorithm='brute')
-        classifier.fit(Xtrain, ytrain)
-        pred = classifier.predict(Xtest)
+        classifier = KNeighborsClassifier(n_neighbors = k, algorithm='brute',
+                                          n_jobs=-1)
+    classifier.fit(Xtrain, ytrain)
+    # Predict in chunks so the distance matrix stays bounded in memory
+    pred = np.concatenate([classifier.predict(X_batch)
+                           for X_batch in batchifier(Xtest, 2048)])
     return pred
\ No newline at end of file
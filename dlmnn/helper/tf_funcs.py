@@ -61,73 +61,130 @@ def tf_makePairwiseFunc(trans_func):
     return dist_func
 
 #%%
-def tf_findImposters(D, y, tN, margin=1):
+def tf_pairDist(Z, sq, idx1, idx2, dtype=None):
+    ''' Squared euclidian distance between rows idx1 and idx2 of the feature
+        matrix Z, computed with the identity |x-y|^2 = |x|^2 + |y|^2 - 2*x^T*y
+        so only the requested pairs are ever touched
+    Arguments:
+        Z: N x d matrix with features
+        sq: N x 1 vector with squared norms of the rows of Z
+        idx1: M x 1 vector with row indices
+        idx2: M x 1 vector with row indices
+        dtype: optional reduced precision type (e.g. tf.float16) used for the
+            elementwise products; accumulation and the returned distances
+            stay float32
+    Output:
+        D: M x 1 vector with squared distances
+    '''
+    Z1, Z2 = tf.gather(Z, idx1), tf.gather(Z, idx2)
+    if dtype is not None and dtype != Z.dtype:
+        # Multiply in reduced precision but accumulate in float32; a float16
+        # running sum overflows at 65504 for unnormalized features, and the
+        # maximum(0, .) clamp below would silently turn that into distance 0
+        prod = tf.cast(tf.cast(Z1, dtype) * tf.cast(Z2, dtype), tf.float32)
+    else:
+        prod = Z1 * Z2
+    inner = tf.reduce_sum(prod, axis=1)
+    D = tf.gather(sq, idx1) + tf.gather(sq, idx2) - 2.0*inner
+    return tf.maximum(tf.cast(0.0, tf.float32), D)
+
+#%%
+def tf_findImposters(Z, y, tN_i, tN_j, margin=1, sq=None, dtype=None):
     ''' Function for finding imposters in LMNN
-        For a set of observations X and that sets target neighbours in tN, 
-        find all points that violate the following two equations
+        For a set of observations X and that sets target neighbours in
+        (tN_i, tN_j), find all points that violate the following two equations
                 D(i, imposter) <= D(i, target_neighbour) + 1,
                 y(imposter) == y(target_neibour)
         for a given distance measure
-        
+
     Arguments:
-        D: 
-        
+        Z: N x d matrix, with transformed features
+
         y: N x 1 vector, with class labels
-        
-        L: d x d matrix, mahalanobis parametrization where M = L^T*L
-        
-        tN: (N*k) x 2 matrix, where the first column in each row is the
-            observation index and the second column is the index of one
-            of the k target neighbours
+
+        tN_i: (N*k) x 1 vector with observation indices
+
+        tN_j: (N*k) x 1 vector with the matching target neighbour indices
+
+        sq: N x 1 vector with squared norms of the rows of Z. Computed when
+            not supplied; pass it to share the computation with the loss
+
+        dtype: optional reduced precision type (e.g. tf.float16) used for the
+            candidate distance computation
     Output:
-        tup: M x 3, where M is the number of triplets that where found to
-             fullfill the imposter equation. First column in each row is the 
-             observation index, second column is the target neighbour index
-             and the third column is the imposter index
+        tup_i: M x 1 vector with observation indices
+        tup_j: M x 1 vector with target neighbour indices
+        tup_l: M x 1 vector with imposter indices
+        where M is the number of triplets that where found to fullfill the
+        imposter equation
     '''
     with tf.name_scope('findImposters'):
-        N = tf.shape(D)[0]
-        n_tN = tf.shape(tN)[0]
-               
-        # Create all combination of [points, targetneighbours, imposters]
-        possible_imp_array =  tf.expand_dims(tf.reshape(
-            tf.ones((n_tN, N), tf.int32)*tf.range(N), (-1, )), 1)
-        tN_tiled = tf.reshape(tf.tile(tN, [1, N]), (-1, 2))
-        full_idx = tf.concat([tN_tiled, possible_imp_array], axis=1)
-        
-        # Find distances for all combinations
-        tn_index = full_idx[:,:2]
-        im_index = full_idx[:,::2]
-        D_tn = tf.gather_nd(D, tn_index)
-        D_im = tf.gather_nd(D, im_index)
-        
-        # Find actually imposter by evaluating equation
-        y = tf.cast(y, tf.float32) # tf.gather do not support first input.dtype=int32 on GPU
-        cond = tf.logical_and(D_im <= margin + D_tn, tf.logical_not(tf.equal(
-                              tf.gather(y,tn_index[:,1]),tf.gather(y,im_index[:,1]))))
-        full_idx = tf.cast(full_idx, tf.float32) # tf.gather do not support first input.dtype=int32 on GPU
-        tup = tf.boolean_mask(full_idx, cond)
-        tup = tf.cast(tup, tf.int32) # tf.gather do not support first input.dtype=int32 on GPU
-        return tup
+        if sq is None:
+            sq = tf.reduce_sum(tf.square(Z), axis=1)
+
+        # Distance to the target neighbour sets the pruning threshold
+        D_tn = tf_pairDist(Z, sq, tN_i, tN_j, dtype=dtype) # n_tN
+        thresh = margin + D_tn
+
+        # Cheap candidate pruning: by the reverse triangle inequality
+        # (|z_i| - |z_l|)^2 <= |z_i - z_l|^2, so candidates whose norm gap
+        # already exceeds the threshold can never be imposters. Combined
+        # with the label mask this leaves a sparse set of candidates, and
+        # the exact O(d) distance is only computed for those
+        norm = tf.sqrt(sq)
+        lower_bound = tf.square(tf.expand_dims(tf.gather(norm, tN_i), 1)
+                                - tf.expand_dims(norm, 0)) # n_tN x N
+        y_tn = tf.gather(y, tN_j)
+        cand = tf.logical_and(tf.not_equal(tf.expand_dims(y_tn, 1),
+                                           tf.expand_dims(y, 0)),
+                              lower_bound <= tf.expand_dims(thresh, 1))
+
+        # Exact distances for the surviving (row in tN, candidate) pairs
+        idx = tf.cast(tf.where(cand), tf.int32)
+        rows, cand_l = idx[:,0], idx[:,1]
+        cand_i = tf.gather(tN_i, rows)
+        D_im = tf_pairDist(Z, sq, cand_i, cand_l, dtype=dtype)
+        keep = D_im <= tf.gather(thresh, rows)
+
+        # Convert what is left into the triplet index vectors
+        tup_i = tf.boolean_mask(cand_i, keep)
+        tup_l = tf.boolean_mask(cand_l, keep)
+        rows = tf.boolean_mask(rows, keep)
+        tup_j = tf.gather(tN_j, rows)
+        return tup_i, tup_j, tup_l
 
 #%%    
-def tf_LMNN_loss(D, tN, tup, mu, margin=1):
+def tf_LMNN_loss(Z, tN_i, tN_j, tup_i, tup_j, tup_l, mu, margin=1, sq=None,
+                 dtype=None, D_pull=None):
     ''' Calculates the LMNN loss (eq. 13 in paper)
-    
+
     Arguments:
-        D: 
-    
-        tN: (N*k) x 2 matrix, with targetmetric,  neighbour index
-        
-        tup: ? x 3, where M is the number of triplets that where found to
-             fullfill the imposter equation. First column in each row is the 
-             observation index, second column is the target neighbour index
-             and the third column is the imposter index
-             
+        Z: N x d matrix, with transformed features
+
+        tN_i: (N*k) x 1 vector with observation indices
+
+        tN_j: (N*k) x 1 vector with the matching target neighbour indices
+
+        tup_i: ? x 1 vector with observation indices of the imposter triplets
+
+        tup_j: ? x 1 vector with the target neighbour indices of the triplets
+
+        tup_l: ? x 1 vector with the imposter indices of the triplets
+
         mu: scalar, weighting coefficient between the push and pull term
-        
+
         margin: scalar, margin for the algorithm
-    
+
+        sq: N x 1 vector with squared norms of the rows of Z. Computed when
+            not supplied; pass it to share the computation with the
+            imposter search
+
+        dtype: optional reduced precision type (e.g. tf.float16) used for the
+            pairwise distance inner products
+
+        D_pull: optional (N*k) x 1 vector with precomputed pull distances for
+            the target neighbour pairs; when given the pull term is not
+            recomputed from Z
     Output:
         loss: scalar, the LMNN loss
         D_pull: ? x 1 vector, with pull distance terms
@@ -135,11 +192,14 @@ def tf_LMNN_loss(D, tN, tup, mu, margin=1):
         D_im: ? x 1 vector, with the second push distance terms
     '''
     with tf.name_scope('LMNN_loss'):
-        # Gather relevant distances
-        D_pull = tf.gather_nd(D, tN)
-        D_tn = tf.gather_nd(D, tup[:,:2])
-        D_im = tf.gather_nd(D, tup[:,::2])
-        
+        # Compute only the O(|tN| + |tup|) distances that enter the loss
+        if sq is None:
+            sq = tf.reduce_sum(tf.square(Z), axis=1)
+        if D_pull is None:
+            D_pull = tf_pairDist(Z, sq, tN_i, tN_j, dtype=dtype)
+        D_tn = tf_pairDist(Z, sq, tup_i, tup_j, dtype=dtype)
+        D_im = tf_pairDist(Z, sq, tup_i, tup_l, dtype=dtype)
+
         # Calculate pull and push loss
         pull_loss = tf.reduce_sum(D_pull)
         push_loss = tf.reduce_sum(margin + D_tn - D_im)            
@@ -160,7 +220,6 @@ def tf_LMNN_loss_smooth(D, y, tN, mu, margin=1):
     tup = tf.concat([tN_tiled, possible_imp_array], axis=1)
     
     # Index for tn and im
-    y = tf.cast(y, tf.float32)
     tn_y = tf.gather(y, tup[:,1])
     im_y = tf.gather(y, tup[:,2])
     cond = tf.equal(tn_y, im_y)
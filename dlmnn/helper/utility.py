@@ -11,40 +11,57 @@ import numpy as np
 
 #%%
 class lmnn_batch_builder():
-    def __init__(self, X, y, tN, imp, k, batch_size, shuffel=True):
+    def __init__(self, X, y, tN, imp, k, batch_size, shuffel=True,
+                 yield_rows=False):
         # Data
         self.X = X
         self.y = y
-        
+
         # Append imposters to target neighbour structure
         imp_r = imp[:,1].repeat(k) # repeat the imposters
         imp_r = imp_r.reshape((-1,k,k)).transpose((0,2,1)).reshape((-1,k))
         self.combined = np.hstack((tN, imp_r))
-        
-        # Shuffel
+
+        # Shuffel by permuting indices, so the original tN row of each
+        # combined row stays known and per-row side data (e.g. the cached
+        # pull differences on the device) can be indexed instead of copied
         if shuffel:
-            self.combined = np.random.permutation(self.combined)
-        
+            perm = np.random.permutation(len(self.combined))
+            self.combined = self.combined[perm]
+        else:
+            perm = np.arange(len(self.combined))
+        self.rows = perm.astype(np.int32) if yield_rows else None
+
         # Constants
         self.batch_size = batch_size
         self.counter = 0
         self.n = tN.shape[0]
-        
+
+        # Preallocated lookup table for remapping global indices to batch
+        # local indices, reused for every batch
+        self._remap = np.empty(X.shape[0], np.int32)
+
+    def _make_batch(self, start):
+        batch_idx = self.combined[start:start+self.batch_size]
+        idx = np.unique(batch_idx)
+        self._remap[idx] = np.arange(len(idx), dtype=np.int32)
+        inv_idx = self._remap[batch_idx[:,:2]]
+        if self.rows is not None:
+            return (self.X[idx], self.y[idx], inv_idx,
+                    self.rows[start:start+self.batch_size])
+        return self.X[idx], self.y[idx], inv_idx
+
     def __next__(self):
-        batch_idx = self.combined[self.counter:self.counter+self.batch_size]
+        start = self.counter
         self.counter += self.batch_size
-        idx, inv_idx = np.unique(batch_idx, return_inverse=True)
-        inv_idx = np.reshape(inv_idx, (-1, 5))[:,:2]
-        return self.X[idx], self.y[idx], inv_idx
-    
+        return self._make_batch(start)
+
     def __iter__(self):
         while self.counter < self.n:
-            batch_idx = self.combined[self.counter:self.counter+self.batch_size]
+            start = self.counter
             self.counter += self.batch_size
-            idx, inv_idx = np.unique(batch_idx, return_inverse=True)
-            inv_idx = np.reshape(inv_idx, (-1, 5))[:,:2]
-            yield self.X[idx], self.y[idx], inv_idx
-    
+            yield self._make_batch(start)
+
     def __len__(self):
         return int(np.ceil(self.n / self.batch_size))
 
@@ -93,10 +110,16 @@ def colorise(string, color='green'):
 #%%
 def progressBar(value, endvalue, name = 'Process', bar_length=20):
     percent = float(value) / endvalue
+    shown = int(round(percent * 100))
+    # Only touch stdout when the displayed percentage actually changes;
+    # for tight loops this removes almost all write/flush syscalls
+    if shown == getattr(progressBar, '_last_shown', None) and value < endvalue:
+        return
+    progressBar._last_shown = None if value >= endvalue else shown
     arrow = '-' * int(round(percent * bar_length)-1) + '>'
     spaces = ' ' * (bar_length - len(arrow))
 
-    sys.stdout.write("\r{0}: [{1}] {2}%".format(name, arrow + spaces, int(round(percent * 100))))
+    sys.stdout.write("\r{0}: [{1}] {2}%".format(name, arrow + spaces, shown))
     sys.stdout.flush()
     
 #%%
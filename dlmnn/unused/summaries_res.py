@@ -10,16 +10,19 @@ Created on Mon Jun 11 11:45:45 2018
 import numpy as np
 from prettytable import PrettyTable
 import os
+from glob import glob
 
 #%%
 def load_res(folder):
     results = dict()
-    for f in os.listdir(folder):
-        if 'performance' in f:
-            name = '_'.join(f.split('_')[1:])[:-4]
-            res=np.load(folder+'/'+f)
-            results[name] = np.round(res, 3)
-    
+    # Match the result files in one glob and memory-map them; rounding is
+    # deferred to display time, so only the rows that end up in the table
+    # get pulled from disk
+    for path in glob(folder + '/*performance*'):
+        f = os.path.basename(path)
+        name = '_'.join(f.split('_')[1:])[:-4]
+        results[name] = np.load(path, mmap_mode='r')
+
     return results
 
 def argparser():
@@ -38,7 +41,7 @@ if __name__ == '__main__':
     
     t = PrettyTable(['Dataset', 'KNN', 'CONV', 'CONV-KNN', 'LMNN', 'LMNN-Redo'])
     for key, value in results.items():
-        t.add_row([key, *value])
+        t.add_row([key, *np.round(value, 3)])
     t.align = 'l'
     print(t)
     